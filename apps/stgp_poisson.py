@@ -1,8 +1,5 @@
 from dctkit.dec import cochain as C
 from dctkit.mesh.simplex import SimplicialComplex
-import networkx as nx
-import matplotlib.pyplot as plt
-from matplotlib import tri
 import deap
 from deap import gp, tools, base, creator
 import dctkit
@@ -12,16 +9,24 @@ from alpine.gp import gpsymbreg as gps
 
 import numpy as np
 import warnings
+import jax
 import jax.numpy as jnp
-from jax import jit, grad
+from jax import jit, vmap
 from scipy.optimize import minimize
 import operator
-import math
 import mpire
+import multiprocessing
 import time
 import sys
 import yaml
 import os
+from collections import OrderedDict
+from functools import partial
+
+try:
+    from jaxopt import LBFGS
+except ImportError:
+    LBFGS = None
 
 apps_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -47,10 +52,35 @@ primitives_strings = get_primitives_strings(pset, types)
 
 
 class ObjFunction:
-    def __init__(self, S: SimplicialComplex, bnodes: np.array, gamma: float) -> None:
+    def __init__(self, S: SimplicialComplex, bnodes: np.array, gamma: float,
+                 maxiter: int = 1000, tol: float = 1e-5) -> None:
         self.S = S
-        self.bnodes = bnodes
+        # contiguous int64 indices, so that gathering the boundary values is a
+        # single-stride access (gmsh returns unsigned node tags)
+        self.bnodes = np.ascontiguousarray(bnodes, dtype=np.int64)
         self.gamma = gamma
+        if LBFGS is not None:
+            # the solver (and the vmapped solve over a batch of samples) is built once
+            # per objective, so that it is traced and compiled once into a single XLA
+            # graph. tol bounds the l2 norm of the gradient, hence it is not looser
+            # than scipy's L-BFGS-B default (gtol=1e-5 on the max-norm of the
+            # projected gradient). In a vmapped while_loop the whole batch runs until
+            # its slowest sample stops, hence the solver stops when the line search
+            # fails (like scipy's abnormal termination, e.g. on unbounded or NaN
+            # energies) and maxiter is well below scipy's default of 15000.
+            self.solver = LBFGS(fun=self.value_and_grad, value_and_grad=True,
+                                maxiter=maxiter, tol=tol, jit=True,
+                                stop_if_linesearch_fails=True)
+            # batched solve, split among the CPU devices when there are several
+            self.n_devices = jax.local_device_count()
+            batched_solve = vmap(self.solve, in_axes=(0, 0, 0))
+            if self.n_devices > 1:
+                self._solve_batch = jax.pmap(batched_solve)
+            else:
+                self._solve_batch = jit(batched_solve)
+        else:
+            # objective and its jacobian wrt its first argument (vec_x), compiled once
+            self.value_and_grad_jit = jit(self.value_and_grad)
 
     def set_energy_func(self, func, individual):
         """Set the energy function to be used for the computation of the objective
@@ -58,30 +88,100 @@ class ObjFunction:
         self.energy_func = func
         self.individual = individual
 
-    def total_energy(self, vec_x, vec_y, vec_bvalues):
-        penalty = 0.5*self.gamma*jnp.sum((vec_x[self.bnodes] - vec_bvalues)**2)
+    def energy(self, vec_x, vec_y):
         c = C.CochainP0(self.S, vec_x)
         fk = C.CochainP0(self.S, vec_y)
-        energy = self.energy_func(c, fk) + penalty
-        return energy
+        return self.energy_func(c, fk)
 
+    def total_energy(self, vec_x, vec_y, vec_bvalues):
+        penalty = 0.5*self.gamma*jnp.sum((vec_x[self.bnodes] - vec_bvalues)**2)
+        energy = self.energy(vec_x, vec_y) + penalty
+        return energy
 
-def eval_MSE(individual: gp.PrimitiveTree, X: np.array, y: np.array,
-             bvalues: dict, S: SimplicialComplex, bnodes: np.array,
-             gamma: float, u_0: np.array, toolbox: base.Toolbox, return_best_sol=False) -> float:
-    """Evaluate total MSE over the dataset.
+    def value_and_grad(self, vec_x, vec_y, vec_bvalues):
+        """Compute the total energy and its gradient wrt vec_x. Only the energy of the
+        individual is differentiated (in reverse mode); the gradient of the penalty
+        on the boundary values is computed analytically."""
+        energy, grad_energy = jax.value_and_grad(self.energy)(vec_x, vec_y)
+        diff = vec_x[self.bnodes] - vec_bvalues
+        penalty = 0.5*self.gamma*jnp.sum(diff**2)
+        grad_penalty = jnp.zeros_like(vec_x).at[self.bnodes].add(self.gamma*diff)
+        return energy + penalty, grad_energy + grad_penalty
+
+    def scipy_value_and_grad(self, vec_x, vec_y, vec_bvalues):
+        """Compiled total energy and gradient, converted to the types expected by
+        scipy.optimize.minimize (with jac=True)."""
+        energy, grad_energy = self.value_and_grad_jit(vec_x, vec_y, vec_bvalues)
+        return float(energy), np.asarray(grad_energy)
+
+    def solve(self, vec_x, vec_y, vec_bvalues):
+        """Minimize the total energy of a single sample with L-BFGS (jaxopt). The
+        function is vmap-friendly, so that a batch of samples can be solved in a
+        single XLA call.
+
+        Args:
+            vec_x: initial guess for the solution.
+            vec_y: source term.
+            vec_bvalues: boundary values.
+
+        Returns:
+            the minimizer of the total energy.
+        """
+        return self.solver.run(vec_x, vec_y, vec_bvalues).params
+
+    def solve_batch(self, vec_x, vec_y, vec_bvalues):
+        """Minimize the total energy of a batch of samples.
+
+        Args:
+            vec_x: (B, N) array of initial guesses.
+            vec_y: (B, N) array of source terms.
+            vec_bvalues: (B, num_bnodes) array of boundary values.
+
+        Returns:
+            (B, N) array of minimizers.
+        """
+        num_samples = vec_y.shape[0]
+        n_devices = self.n_devices
+        if n_devices > 1:
+            # split the batch among the devices, padding it with copies of the last
+            # sample so that its size is a multiple of the number of devices
+            n_pad = -num_samples % n_devices
+            vec_x, vec_y, vec_bvalues = [
+                jnp.concatenate([v, jnp.repeat(v[-1:], n_pad, axis=0)]).reshape(
+                    n_devices, -1, v.shape[-1]) for v in (vec_x, vec_y, vec_bvalues)]
+
+        xs = self._solve_batch(vec_x, vec_y, vec_bvalues)
+        return xs.reshape(-1, xs.shape[-1])[:num_samples]
+
+
+# process-local cache of the objective functions of the individuals evaluated so far,
+# keyed by the structure of the tree: identical trees reuse the jitted solver (and
+# hence the XLA binaries) instead of tracing and compiling it again
+# (each entry holds its compiled solver, tens of MB: see obj_cache_size in the config)
+_obj_cache = OrderedDict()
+OBJ_CACHE_SIZE = 32
+
+
+def compile_individual(individual: gp.PrimitiveTree, S: SimplicialComplex,
+                       bnodes: np.array, gamma: float, u_0: C.CochainP0,
+                       toolbox: base.Toolbox) -> ObjFunction:
+    """Return the objective function associated to an individual, retrieving it from
+    the cache if an individual with the same structure has already been compiled.
 
     Args:
-        individual: individual to evaluate.
-        X: samples of the dataset.
-        y: targets of the dataset.
-        bvalues: array containing the boundary values of the dataset functions.
-        return_best_sol: True if we want the best solution (in this case the function
-        returns it).
+        individual: individual to compile.
+        u_0: initial guess for the solution (its shape and dtype are part of the key).
 
     Returns:
-        total MSE over the dataset.
+        objective function whose energy function is the compiled individual.
     """
+    # the mesh and the penalty parameter are fixed for a run, but they are kept in
+    # the key so that the cache never mixes objectives of different problems
+    key = (str(individual), u_0.coeffs.shape, str(u_0.coeffs.dtype), id(S), gamma)
+    obj = _obj_cache.get(key)
+    if obj is not None:
+        _obj_cache.move_to_end(key)
+        return obj
 
     # transform the individual expression into a callable function
     energy_func = toolbox.compile(expr=individual)
@@ -90,42 +190,93 @@ def eval_MSE(individual: gp.PrimitiveTree, X: np.array, y: np.array,
     obj = ObjFunction(S, bnodes, gamma)
     obj.set_energy_func(energy_func, individual)
 
-    # compute/compile jacobian of the objective wrt its first argument (vec_x)
-    jac = jit(grad(obj.total_energy))
+    _obj_cache[key] = obj
+    if len(_obj_cache) > OBJ_CACHE_SIZE:
+        # evict the least recently used objective
+        _obj_cache.popitem(last=False)
+    return obj
 
-    total_err = 0.
 
-    best_sols = []
+def eval_MSE(individual: gp.PrimitiveTree, X: np.array, y: np.array,
+             bvalues: dict, S: SimplicialComplex, bnodes: np.array,
+             gamma: float, u_0: np.array, toolbox: base.Toolbox, return_best_sol=False,
+             max_err=None) -> float:
+    """Evaluate total MSE over the dataset.
 
-    # TODO: parallelize using vmap once we can use jaxopt
-    for i, vec_y in enumerate(y):
-        # extract current bvalues
-        vec_bvalues = bvalues[i, :]
+    Args:
+        individual: individual to evaluate.
+        X: samples of the dataset.
+        y: targets of the dataset.
+        bvalues: array containing the boundary values of the dataset functions.
+        return_best_sol: True if we want the best solution (in this case the function
+        returns it).
+        max_err: if given and the samples are solved one at a time (scipy path),
+        stop as soon as the MSE cannot be smaller than max_err and return the largest
+        possible MSE (100).
 
-        # minimize the objective
-        x = minimize(fun=obj.total_energy, x0=u_0.coeffs,
-                     args=(vec_y, vec_bvalues), method="L-BFGS-B", jac=jac).x
-        if return_best_sol:
-            best_sols.append(x)
+    Returns:
+        total MSE over the dataset.
+    """
 
-        current_err = np.linalg.norm(x-X[i, :])**2
+    obj = compile_individual(individual, S, bnodes, gamma, u_0, toolbox)
 
-        if current_err > 100 or math.isnan(current_err):
-            current_err = 100
+    # move targets and boundary values to the device once, instead of copying each
+    # row at every call of the objective
+    y_dev = jnp.asarray(y)
+    bv_dev = jnp.asarray(bvalues)
 
-        total_err += current_err
+    if LBFGS is not None:
+        # solve all the samples at once: (B, N) initial guesses, targets and boundary
+        # values are mapped over their first axis
+        x_0 = jnp.broadcast_to(u_0.coeffs, y.shape)
+        xs = obj.solve_batch(x_0, y_dev, bv_dev)
+    else:
+        # contiguous float64 initial guess, so that scipy does not copy it
+        x_0 = np.ascontiguousarray(u_0.coeffs, dtype=np.float64)
+        xs = []
+        # sum of the (clamped) squared errors of the samples solved so far
+        running_err = 0.
+        for i, vec_y in enumerate(y_dev):
+            # extract current bvalues
+            vec_bvalues = bv_dev[i]
+
+            # minimize the objective
+            x = minimize(fun=obj.scipy_value_and_grad, x0=x_0,
+                         args=(vec_y, vec_bvalues), method="L-BFGS-B",
+                         jac=True).x
+            xs.append(x)
+
+            if max_err is not None and not return_best_sol:
+                current_err = np.sum((x - X[i, :])**2)
+                if current_err > 100 or not np.isfinite(current_err):
+                    current_err = 100.
+                running_err += current_err
+                # the errors are non-negative, so the running sum is a lower bound
+                # for the total error
+                if running_err > max_err*X.shape[0]:
+                    return 100.
+
+    # (B, N) array of the solutions
+    best_sols = np.asarray(xs)
 
     if return_best_sol:
         return best_sols
 
-    total_err *= 1/(X.shape[0])
+    # squared errors of all the samples at once, clamped to 100 (also when the
+    # solution diverged)
+    diff = best_sols - X
+    errs = np.einsum("ij,ij->i", diff, diff)
+    errs = np.where(~np.isfinite(errs) | (errs > 100.), 100., errs)
+
+    total_err = errs.mean()
 
     return total_err
 
 
 def eval_fitness(individual: gp.PrimitiveTree, X: np.array, y: np.array, bvalues: dict,
                  S: SimplicialComplex, bnodes: np.array, gamma: float, u_0: np.array, penalty: dict,
-                 toolbox: base.Toolbox) -> (float, ):
+                 toolbox: base.Toolbox, current_best=None,
+                 early_sample_exit=False) -> (float, ):
     """Evaluate total fitness over the dataset.
 
     Args:
@@ -135,32 +286,55 @@ def eval_fitness(individual: gp.PrimitiveTree, X: np.array, y: np.array, bvalues
         bvalues: np.array containing the boundary values of the dataset functions.
         penalty: dictionary containing the penalty method (regularization) and the
         penalty multiplier.
+        current_best: shared value (multiprocessing.Value) holding the best fitness
+        found so far. If given, individuals whose penalty alone is not smaller than it
+        are not evaluated on the dataset.
+        early_sample_exit: if True (and current_best is given), stop solving the
+        samples as soon as the fitness cannot be smaller than current_best.
 
     Returns:
         total fitness over the dataset.
     """
 
-    objval = 0.
-
-    total_err = eval_MSE(individual, X, y, bvalues, S, bnodes, gamma, u_0, toolbox)
-
     if penalty["method"] == "primitive":
         # penalty terms on primitives
         indstr = str(individual)
-        objval = total_err + penalty["reg_param"] * \
+        penalty_term = penalty["reg_param"] * \
             max([indstr.count(string) for string in primitives_strings])
     elif penalty["method"] == "length":
         # penalty terms on length
-        objval = total_err + penalty["reg_param"]*len(individual)
+        penalty_term = penalty["reg_param"]*len(individual)
     else:
         # no penalty
-        objval = total_err
+        penalty_term = 0.
+
+    # the penalty is a lower bound for the fitness (the MSE is non-negative): if it
+    # already exceeds the best fitness, skip the evaluation and assign the largest
+    # possible MSE (the errors are clamped to 100)
+    if current_best is not None and penalty_term >= current_best.value:
+        return penalty_term + 100.,
+
+    max_err = None
+    if early_sample_exit and current_best is not None:
+        max_err = current_best.value - penalty_term
+
+    total_err = eval_MSE(individual, X, y, bvalues, S, bnodes, gamma, u_0, toolbox,
+                         max_err=max_err)
+
+    objval = total_err + penalty_term
     return objval,
 
 
+def update_current_best(best: gp.PrimitiveTree, current_best):
+    """Store the fitness of the best individual in the shared value read by the
+    workers in eval_fitness."""
+    current_best.value = best.fitness.values[0]
+
+
 # Plot best solution
 def plot_sol(ind: gp.PrimitiveTree, X: np.array, y: np.array, bvalues: dict, S: SimplicialComplex,
-             bnodes: np.array, gamma: float, u_0: np.array, triang: tri.Triangulation,  toolbox: base.Toolbox):
+             bnodes: np.array, gamma: float, u_0: np.array, triang,  toolbox: base.Toolbox):
+    import matplotlib.pyplot as plt
     u = eval_MSE(ind, X=X, y=y, bvalues=bvalues, S=S,
                  bnodes=bnodes, gamma=gamma, u_0=u_0, toolbox=toolbox, return_best_sol=True)
     plt.figure(10, figsize=(8, 4))
@@ -177,7 +351,107 @@ def plot_sol(ind: gp.PrimitiveTree, X: np.array, y: np.array, bvalues: dict, S:
     plt.pause(0.1)
 
 
+def plot_tree(ind: gp.PrimitiveTree):
+    """Plot the tree of an individual (requires graphviz)."""
+    import matplotlib.pyplot as plt
+    import networkx as nx
+    nodes, edges, labels = gp.graph(ind)
+    graph = nx.Graph()
+    graph.add_nodes_from(nodes)
+    graph.add_edges_from(edges)
+    pos = nx.nx_agraph.graphviz_layout(graph, prog="dot")
+    plt.figure(figsize=(7, 7))
+    nx.draw_networkx_nodes(graph, pos, node_size=900, node_color="w")
+    nx.draw_networkx_edges(graph, pos)
+    nx.draw_networkx_labels(graph, pos, labels)
+    plt.axis("off")
+    plt.show()
+
+
+def share_compilation_cache(cache_dir: str, max_size: int) -> bool:
+    """Store the compiled XLA executables in a cache directory shared by all the
+    processes, so that a tree compiled by one worker (or by a previous run) is loaded
+    instead of being compiled again. Must be called before anything is compiled.
+
+    Args:
+        cache_dir: path of the cache directory. It is created (readable and writable
+        only by the current user) if it does not exist; since the cached executables
+        are loaded and run, it must not be writable by other users.
+        max_size: maximum size of the cache in bytes.
+
+    Returns:
+        True if the cache could be enabled, False if the installed JAX does not
+        support it (in this case every worker compiles its own executables).
+    """
+    cache_dir = os.path.expanduser(cache_dir)
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    try:
+        jax.config.update("jax_compilation_cache_dir", cache_dir)
+    except AttributeError:
+        return False
+    try:
+        jax.config.update("jax_compilation_cache_max_size", max_size)
+    except AttributeError:
+        # without a bound on the size, keep the default threshold on the compile
+        # time, so that only the most expensive trees are cached
+        return True
+    # the trees are small, so their compile times are typically below the default
+    # threshold for caching
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+    return True
+
+
+def set_host_device_count(n_devices: int):
+    """Split the CPU into multiple XLA devices, so that the samples of the dataset
+    can be solved in parallel (with pmap) within a single evaluation. Must be called
+    before the JAX backend is initialized.
+
+    Args:
+        n_devices: number of CPU devices.
+    """
+    flags = os.environ.get("XLA_FLAGS", "")
+    os.environ["XLA_FLAGS"] = flags + \
+        " --xla_force_host_platform_device_count=%d" % n_devices
+
+
+def warm_jax(num_nodes: int):
+    """Initialize the JAX backend of a worker by compiling and running a dummy
+    function, so that the first evaluation does not pay for it.
+
+    Args:
+        num_nodes: number of nodes of the mesh.
+    """
+    dummy = jnp.zeros(num_nodes)
+    jit(lambda x: (x*x).sum())(dummy).block_until_ready()
+
+
+def init_worker(num_nodes: int, obj_cache_size: int):
+    """Initialize a worker of the pool: set the maximum number of objective functions
+    kept in its cache and warm up its JAX backend.
+
+    Args:
+        num_nodes: number of nodes of the mesh.
+        obj_cache_size: maximum number of compiled individuals cached by the worker.
+    """
+    global OBJ_CACHE_SIZE
+    OBJ_CACHE_SIZE = obj_cache_size
+    warm_jax(num_nodes)
+
+
 def stgp_poisson(config_file):
+    n_jobs = config_file["mp"]["n_jobs"]
+    n_devices = config_file["mp"]["n_devices"]
+    if n_devices > 1:
+        set_host_device_count(n_devices)
+        if n_jobs*n_devices > os.cpu_count():
+            print(f"WARNING: {n_jobs} jobs x {n_devices} devices oversubscribe the "
+                  f"{os.cpu_count()} available cores.", flush=True)
+
+    # persist the compiled XLA executables across runs (and share them among the
+    # workers): this must be done before anything is compiled
+    share_compilation_cache(config_file["mp"]["xla_cache_dir"],
+                            config_file["mp"]["xla_cache_max_size"])
+
     # generate mesh and dataset
     S, bnodes, triang = d.generate_complex("test3.msh")
     num_nodes = S.num_nodes
@@ -213,6 +487,7 @@ def stgp_poisson(config_file):
     early_stopping = config_file["gp"]["early_stopping"]
     parsimony_pressure = config_file["gp"]["parsimony_pressure"]
     penalty = config_file["gp"]["penalty"]
+    early_sample_exit = config_file["gp"]["early_sample_exit"]
 
     tournsize = config_file["gp"]["select"]["tournsize"]
     stochastic_tournament = config_file["gp"]["select"]["stochastic_tournament"]
@@ -238,8 +513,8 @@ def stgp_poisson(config_file):
     plot_best = config_file["plot"]["plot_best"]
     plot_best_genealogy = config_file["plot"]["plot_best_genealogy"]
 
-    n_jobs = config_file["mp"]["n_jobs"]
     n_splits = config_file["mp"]["n_splits"]
+    obj_cache_size = config_file["mp"]["obj_cache_size"]
     start_method = config_file["mp"]["start_method"]
 
     toolbox.register("expr", gp.genHalfAndHalf,
@@ -259,6 +534,10 @@ def stgp_poisson(config_file):
     toolbox.register("compile", gp.compile, pset=pset)
     start = time.perf_counter()
 
+    # best fitness on the training set, shared with the workers (that inherit it when
+    # forked) to skip the evaluation of individuals that cannot improve on it
+    current_best = multiprocessing.Value('d', np.inf)
+
     # add functions for fitness evaluation (value of the objective function) on training
     # set and MSE evaluation on validation set
     toolbox.register("evaluate_train",
@@ -271,7 +550,11 @@ def stgp_poisson(config_file):
                      bnodes=bnodes,
                      gamma=gamma,
                      u_0=u_0,
-                     toolbox=toolbox)
+                     toolbox=toolbox,
+                     current_best=current_best,
+                     early_sample_exit=early_sample_exit)
+    toolbox.register("update_best_func", update_current_best,
+                     current_best=current_best)
     toolbox.register("evaluate_val_fit",
                      eval_fitness,
                      X=X_val,
@@ -314,8 +597,12 @@ def stgp_poisson(config_file):
                                      toolbox=toolbox)
 
     print("> MODEL TRAINING/SELECTION STARTED", flush=True)
-    pool = mpire.WorkerPool(n_jobs=n_jobs, start_method=start_method)
-    GPproblem.toolbox.register("map", pool.map)
+    # keep the workers alive across generations, so that their caches of compiled
+    # individuals are reused
+    pool = mpire.WorkerPool(n_jobs=n_jobs, start_method=start_method, keep_alive=True)
+    GPproblem.toolbox.register("map", pool.map,
+                               worker_init=partial(init_worker, num_nodes=num_nodes,
+                                                   obj_cache_size=obj_cache_size))
     GPproblem.run(plot_history=True,
                   print_log=True,
                   plot_best=plot_best,
@@ -323,6 +610,7 @@ def stgp_poisson(config_file):
                   seed=None,
                   n_splits=n_splits,
                   early_stopping=early_stopping)
+    pool.stop_and_join()
 
     best = GPproblem.best
     print(f"The best individual is {str(best)}", flush=True)
@@ -338,18 +626,10 @@ def stgp_poisson(config_file):
 
     print(f"Elapsed time: {round(time.perf_counter() - start, 2)}")
 
-    # plot the tree of the best individual
-    nodes, edges, labels = gp.graph(best)
-    graph = nx.Graph()
-    graph.add_nodes_from(nodes)
-    graph.add_edges_from(edges)
-    pos = nx.nx_agraph.graphviz_layout(graph, prog="dot")
-    plt.figure(figsize=(7, 7))
-    nx.draw_networkx_nodes(graph, pos, node_size=900, node_color="w")
-    nx.draw_networkx_edges(graph, pos)
-    nx.draw_networkx_labels(graph, pos, labels)
-    plt.axis("off")
-    plt.show()
+    # plot the tree of the best individual (only in interactive runs, since the plot
+    # blocks until its window is closed)
+    if plot_best and sys.stdout.isatty():
+        plot_tree(best)
 
     # save data for plots to disk
     np.save("train_fit_history.npy", GPproblem.train_fit_history)
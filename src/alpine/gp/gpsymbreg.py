@@ -175,6 +175,36 @@ class GPSymbRegProblem():
             # Print statistics for the current population
             print(self.logbook.stream, flush=True)
 
+    def evaluate_population(self, individuals, n_splits=10):
+        """Evaluates the fitness of a list of individuals on the training set.
+        Individuals with the same structure are evaluated only once.
+
+            Args:
+                individuals: a list of individuals to evaluate.
+                n_splits: number of chunks the evaluations are split into by map.
+        """
+        # map the string representation of each individual to the first individual
+        # with that structure
+        unique = dict()
+        for ind in individuals:
+            unique.setdefault(str(ind), ind)
+        unique_ind = list(unique.values())
+
+        # NOTE: map sends the individuals to the workers in n_splits chunks, which
+        # are evaluated one after the other by the same (warm) worker process
+        fitnesses = self.toolbox.map(self.toolbox.evaluate_train, make_single_arguments(
+            unique_ind), iterable_len=len(unique_ind), n_splits=n_splits)
+        fitnesses = dict(zip(unique.keys(), fitnesses))
+
+        for ind in individuals:
+            ind.fitness.values = fitnesses[str(ind)]
+
+    def __update_best(self, best):
+        # Notify the best individual of the population (e.g. to skip the evaluation
+        # of individuals that cannot improve on it)
+        if hasattr(self.toolbox, "update_best_func"):
+            self.toolbox.update_best_func(best)
+
     def select_with_elitism(self, individuals):
         """Performs tournament selection with elitism.
 
@@ -267,10 +297,8 @@ class GPSymbRegProblem():
 
         # Evaluate the fitness of the entire population on the training set
         print("Evaluating initial population...", flush=True)
-        fitnesses = list(self.toolbox.map(self.toolbox.evaluate_train, make_single_arguments(
-            self.pop), iterable_len=self.NINDIVIDUALS, n_splits=n_splits))
-        for ind, fit in zip(self.pop, fitnesses):
-            ind.fitness.values = fit
+        self.evaluate_population(self.pop, n_splits=n_splits)
+        self.__update_best(tools.selBest(self.pop, k=1)[0])
 
         print("DONE.", flush=True)
 
@@ -304,17 +332,14 @@ class GPSymbRegProblem():
             # Evaluate the individuals with an invalid fitness (subject to crossover or
             # mutation)
             invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-            fitnesses = self.toolbox.map(self.toolbox.evaluate_train, make_single_arguments(
-                invalid_ind), iterable_len=len(invalid_ind), n_splits=n_splits)
-
-            for ind, fit in zip(invalid_ind, fitnesses):
-                ind.fitness.values = fit
+            self.evaluate_population(invalid_ind, n_splits=n_splits)
 
             # The population is entirely replaced by the offspring
             # self.pop[:] = offspring
             self.pop = tools.selBest(self.pop + offspring, self.NINDIVIDUALS)
             # Select the best individual in the current population
             best = tools.selBest(self.pop, k=1)[0]
+            self.__update_best(best)
 
             # Compute population statistics
             self.compute_statistics(self.pop,
@@ -0,0 +1,50 @@
+import operator
+from deap import base, gp
+from alpine.gp import gpsymbreg as gps
+
+
+class FitnessMin(base.Fitness):
+    weights = (-1.0,)
+
+
+class Individual(gp.PrimitiveTree):
+    def __init__(self, content):
+        super().__init__(content)
+        self.fitness = FitnessMin()
+
+
+def test_evaluate_population_deduplicates():
+    pset = gp.PrimitiveSet("MAIN", 1)
+    pset.addPrimitive(operator.add, 2)
+    pset.addPrimitive(operator.mul, 2)
+    pset.renameArguments(ARG0="x")
+
+    # number of evaluations of each individual (by its string representation)
+    calls = dict()
+
+    def evaluate_train(ind):
+        calls[str(ind)] = calls.get(str(ind), 0) + 1
+        return float(len(calls)),
+
+    def map(func, iterable, iterable_len=None, n_splits=None):
+        return [func(*args) for args in iterable]
+
+    toolbox = base.Toolbox()
+    toolbox.register("evaluate_train", evaluate_train)
+    toolbox.register("map", map)
+
+    problem = gps.GPSymbRegProblem(pset, individualCreator=Individual, toolbox=toolbox)
+
+    exprs = ["add(x, x)", "mul(x, x)", "add(x, x)", "add(x, mul(x, x))",
+             "mul(x, x)", "add(x, x)"]
+    individuals = [Individual(gp.PrimitiveTree.from_string(expr, pset))
+                   for expr in exprs]
+
+    problem.evaluate_population(individuals)
+
+    assert calls == {expr: 1 for expr in set(exprs)}
+    for ind in individuals:
+        assert ind.fitness.valid
+    for expr in set(exprs):
+        fitnesses = {ind.fitness.values for ind in individuals if str(ind) == expr}
+        assert len(fitnesses) == 1
@@ -0,0 +1,143 @@
+import os
+import multiprocessing
+import sys
+from collections import OrderedDict
+import numpy as np
+import jax.numpy as jnp
+from jax import jit, grad
+from scipy.optimize import minimize
+from deap import base, gp
+from dctkit.dec import cochain as C
+from alpine.data import poisson_dataset as d
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..",
+                             "apps"))
+import stgp_poisson as sp  # noqa: E402
+
+# energy of the Poisson problem: 1/2 <du, du> - <u, f>
+energy_str = "Sub(MulF(1/2, Inn1(dP0(u), dP0(u))), Inn0(u, fk))"
+
+
+def test_solve_batch_scipy_parity():
+    np.random.seed(42)
+    S, bnodes, _ = d.generate_complex("test3.msh")
+    X_train, _, _, y_train, _, _ = d.load_dataset()
+    y = y_train[:3]
+    bvalues = X_train[:3, bnodes]
+
+    obj = sp.ObjFunction(S, bnodes, gamma=1000.)
+    obj.set_energy_func(gp.compile(energy_str, sp.pset), energy_str)
+
+    u_0 = 0.01*np.random.rand(S.num_nodes)
+    x_0 = jnp.broadcast_to(jnp.asarray(u_0), y.shape)
+    xs = np.asarray(obj.solve_batch(x_0, jnp.asarray(y), jnp.asarray(bvalues)))
+
+    value_and_grad = jit(obj.value_and_grad)
+
+    def fun(x, vec_y, vec_bvalues):
+        energy, grad_energy = value_and_grad(x, vec_y, vec_bvalues)
+        return float(energy), np.asarray(grad_energy)
+
+    for i in range(y.shape[0]):
+        x_scipy = minimize(fun=fun, x0=u_0, args=(y[i], bvalues[i]),
+                           method="L-BFGS-B", jac=True).x
+        assert np.allclose(xs[i], x_scipy, rtol=1e-3, atol=1e-3)
+
+
+def test_value_and_grad():
+    np.random.seed(42)
+    S, _, _ = d.generate_complex("test3.msh")
+    # repeated boundary indices, where the scatter-add of the penalty gradient must
+    # accumulate the contributions
+    bnodes = np.array([0, 1, 1, 5, 5, 5])
+
+    obj = sp.ObjFunction(S, bnodes, gamma=1000.)
+    obj.set_energy_func(gp.compile(energy_str, sp.pset), energy_str)
+
+    vec_x = jnp.asarray(np.random.rand(S.num_nodes))
+    vec_y = jnp.asarray(np.random.rand(S.num_nodes))
+    vec_bvalues = jnp.asarray(np.random.rand(len(bnodes)))
+
+    energy, grad_energy = obj.value_and_grad(vec_x, vec_y, vec_bvalues)
+
+    assert np.allclose(energy, obj.total_energy(vec_x, vec_y, vec_bvalues))
+    assert np.allclose(grad_energy, grad(obj.total_energy)(vec_x, vec_y, vec_bvalues))
+
+
+def test_eval_fitness_skips_by_penalty(monkeypatch):
+    calls = []
+
+    def eval_MSE(*args, **kwargs):
+        calls.append(args[0])
+        return 0.5
+
+    monkeypatch.setattr(sp, "eval_MSE", eval_MSE)
+
+    individual = gp.PrimitiveTree.from_string(energy_str, sp.pset)
+    penalty = {"method": "length", "reg_param": 1.}
+    penalty_term = float(len(individual))
+    args = dict(X=None, y=None, bvalues=None, S=None, bnodes=None, gamma=1000.,
+                u_0=None, penalty=penalty, toolbox=None)
+
+    # the penalty alone is not smaller than the best fitness: the MSE is not computed
+    # and the largest possible MSE is assigned
+    current_best = multiprocessing.Value('d', penalty_term)
+    fitness = sp.eval_fitness(individual, current_best=current_best, **args)
+    assert calls == []
+    assert fitness == (penalty_term + 100.,)
+
+    # the individual may improve on the best fitness: the MSE is computed
+    current_best.value = penalty_term + 1.
+    fitness = sp.eval_fitness(individual, current_best=current_best, **args)
+    assert calls == [individual]
+    assert fitness == (penalty_term + 0.5,)
+
+
+def poisson_problem(num_samples=3):
+    """Mesh, first training samples, initial guess and toolbox of the Poisson app."""
+    np.random.seed(42)
+    S, bnodes, _ = d.generate_complex("test3.msh")
+    X_train, _, _, y_train, _, _ = d.load_dataset()
+    X = X_train[:num_samples]
+    y = y_train[:num_samples]
+    bvalues = X[:, bnodes]
+    u_0 = C.CochainP0(S, 0.01*np.random.rand(S.num_nodes))
+    toolbox = base.Toolbox()
+    toolbox.register("compile", gp.compile, pset=sp.pset)
+    return S, bnodes, X, y, bvalues, u_0, toolbox
+
+
+def test_eval_MSE_scipy_fallback(monkeypatch):
+    S, bnodes, X, y, bvalues, u_0, toolbox = poisson_problem()
+    individual = gp.PrimitiveTree.from_string(energy_str, sp.pset)
+    args = (individual, X, y, bvalues, S, bnodes, 1000., u_0, toolbox)
+
+    sols_batched = sp.eval_MSE(*args, return_best_sol=True)
+    mse_batched = sp.eval_MSE(*args)
+
+    # solve the samples one at a time with scipy (with a fresh cache, so that the
+    # objective is built without the jaxopt solver)
+    monkeypatch.setattr(sp, "LBFGS", None)
+    monkeypatch.setattr(sp, "_obj_cache", OrderedDict())
+    sols_scipy = sp.eval_MSE(*args, return_best_sol=True)
+    mse_scipy = sp.eval_MSE(*args)
+
+    assert np.allclose(sols_batched, sols_scipy, rtol=1e-3, atol=1e-3)
+    assert np.isclose(mse_batched, mse_scipy, rtol=1e-3, atol=1e-6)
+
+
+def test_eval_MSE_early_sample_exit(monkeypatch):
+    # the early exit is only available when the samples are solved one at a time
+    monkeypatch.setattr(sp, "LBFGS", None)
+    monkeypatch.setattr(sp, "_obj_cache", OrderedDict())
+    S, bnodes, X, y, bvalues, u_0, toolbox = poisson_problem()
+    individual = gp.PrimitiveTree.from_string(energy_str, sp.pset)
+    args = (individual, X, y, bvalues, S, bnodes, 1000., u_0, toolbox)
+
+    mse = sp.eval_MSE(*args)
+    assert 0. < mse < 100.
+
+    # the MSE can still be smaller than max_err: all the samples are solved
+    assert np.isclose(sp.eval_MSE(*args, max_err=mse*(1 + 1e-6)), mse)
+    # the MSE is larger than max_err: the evaluation is pruned
+    assert sp.eval_MSE(*args, max_err=mse/2) == 100.